@@ -1,10 +1,16 @@
 import os
 import requests
+import requests.adapters
+import urllib3
 import logging
-import hashlib
+import xxhash
 import re
 import argparse
 import sys
+import shutil
+import mmap
+import concurrent.futures
+from tqdm import tqdm
 
 # ---------------------------- #
 #        Argument Parsing       #
@@ -24,24 +30,40 @@ args = parser.parse_args()
 # ---------------------------- #
 
 LOG_FILE = args.log
+MAX_WORKERS = 16  # Number of images retried in parallel
 output_dir = args.output.rstrip(os.sep)
 cookies = {"SMSESS": args.session}  # Session cookie passed as CLI argument
 
+# Shared session so every download reuses pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.cookies.update(cookies)
+SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=0))
+
 # ---------------------------- #
 #        Helper Functions       #
 # ---------------------------- #
 
+# Characters allowed in filenames are word characters, '-', '.' and ' '
+_SANITIZE_RE = re.compile(r'[^\w\-_\. ]')
+# Same rule as _SANITIZE_RE as a lookup table, used for the common all-ASCII case
+_SANITIZE_TABLE = str.maketrans({chr(i): '_' for i in range(128) if not chr(i).isalnum() and chr(i) not in "-_. "})
+_ALBUM_PATH_RE = re.compile(r'photos/(.+)/D')
+# Failed downloads are logged as "Could not fetch image from <url>: <error>"
+_FAILED_URL_RE = re.compile(rb"ERROR - Could not fetch image from (http\S+): ")
+
 def sanitize_filename(filename):
     """
     Sanitizes the filename by replacing unwanted characters with underscores.
     """
-    return re.sub(r'[^\w\-_\. ]', '_', filename)
+    if filename.isascii():
+        return filename.translate(_SANITIZE_TABLE)
+    return _SANITIZE_RE.sub('_', filename)
 
 def get_unique_id(url):
     """
     Generates a unique ID based on the URL.
     """
-    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:8]
+    return xxhash.xxh3_64(url.encode('utf-8')).hexdigest()[:8]
 
 def get_image_filename(url):
     """
@@ -56,19 +78,31 @@ def get_image_filename(url):
 def retry_failed_images():
     """
     Reads the log file for failed image URLs and retries downloading them.
+    The most recent failures are retried first.
     """
     if not os.path.exists(LOG_FILE):
         print(f"Log file '{LOG_FILE}' does not exist.")
         sys.exit(1)
 
-    with open(LOG_FILE, 'r') as log_file:
-        for line in log_file:
-            if "ERROR - Could not fetch image" in line:
-                # Extract the image URL from the log file
-                url_start = line.find("http")
-                if url_start != -1:
-                    image_url = line[url_start:].strip()
-                    download_image(image_url)
+    # Find every failure in a single regex pass over the memory-mapped log, without building per-line strings
+    with open(LOG_FILE, 'rb') as log_file:
+        if os.fstat(log_file.fileno()).st_size == 0:
+            return  # mmap cannot map an empty file
+        with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            failed_urls = _FAILED_URL_RE.findall(mm)
+
+    # The same URL is logged once per failed attempt, so keep only its most recent occurrence,
+    # and retry the most recent failures first
+    image_urls = []
+    seen_urls = set()
+    for image_url in reversed(failed_urls):
+        if image_url not in seen_urls:
+            seen_urls.add(image_url)
+            image_urls.append(image_url.decode('utf-8', errors='replace'))
+
+    # Downloads are network-bound, so threads sharing the session's connection pool overlap them well
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(tqdm(executor.map(download_image, image_urls), total=len(image_urls), desc="Retrying", unit="image"))
 
 def download_image(image_url):
     """
@@ -78,13 +112,12 @@ def download_image(image_url):
     album_url_path = extract_album_path(image_url)
     album_path = os.path.join(output_dir, album_url_path)
 
-    if not os.path.exists(album_path):
-        try:
-            os.makedirs(album_path)
-            logging.info(f"Created directory: {album_path}")
-        except OSError as e:
-            logging.error(f"Could not create directory {album_path}: {e}")
-            return
+    # exist_ok avoids a race when several workers create the same album directory
+    try:
+        os.makedirs(album_path, exist_ok=True)
+    except OSError as e:
+        logging.error(f"Could not create directory {album_path}: {e}")
+        return
 
     # Get the full image path (sanitized and with unique id)
     image_filename = get_image_filename(image_url)
@@ -95,18 +128,24 @@ def download_image(image_url):
         logging.info(f"Image already exists: {image_path}. Skipping.")
         return
 
+    part_path = image_path + ".part"
     try:
         logging.info(f"Downloading image: {image_url}")
-        response = requests.get(image_url, cookies=cookies, stream=True)
-        response.raise_for_status()
-
-        with open(image_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        with SESSION.get(image_url, stream=True) as response:
+            response.raise_for_status()
+            # Let urllib3 undo any content encoding, then copy straight to disk in 1 MiB blocks.
+            # The data goes to a .part file that only replaces image_path once it is complete
+            response.raw.decode_content = True
+            with open(part_path, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, length=1024 * 1024)
+        os.replace(part_path, image_path)
         logging.info(f"Downloaded image: {image_path}")
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
         logging.error(f"Could not fetch image from {image_url}: {e}")
+    finally:
+        # A leftover partial file would otherwise count as downloaded on the next run
+        if os.path.exists(part_path):
+            os.remove(part_path)
 
 def extract_album_path(image_url):
     """
@@ -114,7 +153,7 @@ def extract_album_path(image_url):
     """
     # Example format: https://photos.smugmug.com/photos/i-xxxxx/0/M/album_path/D/i-xxxxx-D.jpg
     # This will extract 'album_path' as the album path
-    match = re.search(r'photos/(.+)/D', image_url)
+    match = _ALBUM_PATH_RE.search(image_url)
     if match:
         return match.group(1)
     return "unknown_album"
@@ -1,12 +1,18 @@
 import os
 import sys
-import requests
-import json
+import orjson
 import re
+import html
+import urllib.parse
 import argparse
-import hashlib
+import xxhash
 import logging
-from bs4 import BeautifulSoup
+import asyncio
+import functools
+import random
+import math
+import aiohttp
+import aiofiles
 from tqdm import tqdm
 from colored import fg, attr
 
@@ -42,6 +48,18 @@ def setup_logging(output_dir):
 #        Argument Parsing      #
 # ---------------------------- #
 
+def positive_int(value):
+    """
+    Argparse type for options that only make sense as a count of at least 1.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
 parser = argparse.ArgumentParser(description="SmugMug Downloader")
 parser.add_argument(
     "-s", "--session", help="Session ID (required if user is password protected); log in on a web browser and paste the SMSESS cookie")
@@ -51,6 +69,10 @@ parser.add_argument("-o", "--output", default="output/",
                     help="Output directory")
 parser.add_argument(
     "--albums", help="Specific album names to download, split by $. Defaults to all. Wrap in single quotes to avoid shell variable substitutions. (e.g. --albums 'Title 1$Title 2$Title 3')")
+parser.add_argument("--concurrency", type=positive_int, default=64,
+                    help="Maximum number of images downloaded at once. Lower this on slow connections.")
+parser.add_argument("--per-host", type=positive_int, default=32,
+                    help="Maximum number of open connections to a single host")
 
 args = parser.parse_args()
 
@@ -60,6 +82,9 @@ args = parser.parse_args()
 
 endpoint = "https://www.smugmug.com"
 
+# Maximum number of open connections across all hosts
+MAX_CONNECTIONS = 128
+
 SMSESS = args.session
 
 if SMSESS:
@@ -95,159 +120,313 @@ else:
 #        Helper Functions      #
 # ---------------------------- #
 
-def get_json(url):
+# Characters allowed in filenames are word characters, '-', '.' and ' '
+_SANITIZE_RE = re.compile(r'[^\w\-_\. ]')
+# Same rule as _SANITIZE_RE as a lookup table, used for the common all-ASCII case
+_SANITIZE_TABLE = str.maketrans({chr(i): '_' for i in range(128) if not chr(i).isalnum() and chr(i) not in "-_. "})
+# The API's HTML view embeds the JSON response in a <pre> block
+_PRE_RE = re.compile(r'<pre[^>]*>(.*?)</pre>', re.DOTALL)
+_TAG_RE = re.compile(r'<[^>]+>')
+
+# Longest Retry-After delay, in seconds, that a rate-limited request will wait for
+MAX_RETRY_AFTER = 120
+
+def is_permanent_error(e):
+    """
+    Returns True for errors that retrying cannot fix: client errors other than
+    timeouts and rate limiting, and responses that could not be parsed.
+    """
+    if isinstance(e, aiohttp.ClientResponseError):
+        return 400 <= e.status < 500 and e.status not in (408, 429)
+    return isinstance(e, ValueError)
+
+def retry(tries=5, backoff=2):
+    """
+    Retries a coroutine with jittered exponential backoff (capped at 30s).
+    A 429 response waits for the server's Retry-After delay instead, up to MAX_RETRY_AFTER.
+    Permanent errors, and the last error once all tries are used up, are re-raised.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for i in range(tries):
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    if i + 1 >= tries or is_permanent_error(e):
+                        raise
+                    delay = min(backoff ** i + random.random(), 30)
+                    if isinstance(e, aiohttp.ClientResponseError) and e.status == 429 and e.headers:
+                        try:
+                            retry_after = float(e.headers.get("Retry-After", delay))
+                        except ValueError:
+                            retry_after = delay  # HTTP-date form is not supported, keep the backoff delay
+                        if math.isfinite(retry_after):
+                            delay = min(max(retry_after, 0), MAX_RETRY_AFTER)
+                    logging.warning(f"{func.__name__} failed: {e}. Retrying in {delay:.1f}s...")
+                    await asyncio.sleep(delay)
+        return wrapper
+    return decorator
+
+@retry(tries=5, backoff=2)
+async def request_json(session, url):
+    """
+    Fetches a page from the SmugMug API and parses the JSON embedded in its last <pre> tag.
+    """
+    async with session.get(endpoint + url) as r:
+        r.raise_for_status()
+        text = await r.text()
+    pres = _PRE_RE.findall(text)
+    if not pres:
+        raise ValueError("No <pre> tags found in response.")
+    # The JSON is HTML-escaped and its URIs are wrapped in links, so strip both
+    return orjson.loads(html.unescape(_TAG_RE.sub('', pres[-1])))
+
+async def fetch_json(session, url):
     """
     Retrieves JSON data from a given URL with retries.
     """
-    num_retries = 5
-    for i in range(num_retries):
-        try:
-            r = requests.get(endpoint + url, cookies=cookies)
-            r.raise_for_status()
-            soup = BeautifulSoup(r.text, "html.parser")
-            pres = soup.find_all("pre")
-            if not pres:
-                raise ValueError("No <pre> tags found in response.")
-            return json.loads(pres[-1].text)
-        except Exception as e:
-            logging.error(f"Error fetching JSON from URL {endpoint + url}: {e}")
-            if i + 1 < num_retries:
-                logging.info("Retrying...")
-            else:
-                logging.error("Max retries reached. Skipping this request.")
-    return None
+    try:
+        return await request_json(session, url)
+    except Exception as e:
+        logging.error(f"Error fetching JSON from URL {endpoint + url}: {e}")
+        logging.error("Giving up on this request.")
+        return None
+
+@retry(tries=5, backoff=2)
+async def fetch_image(session, download_url, image_path):
+    """
+    Streams a single image download to disk.
+    The data goes to a .part file that only replaces image_path once it is complete.
+    """
+    part_path = image_path + ".part"
+    try:
+        async with session.get(download_url) as response:
+            response.raise_for_status()
+            async with aiofiles.open(part_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(65536):
+                    await f.write(chunk)
+        os.replace(part_path, image_path)
+    except BaseException:
+        # A leftover partial file would otherwise count as downloaded on the next run
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
 
 def sanitize_filename(filename):
     """
     Sanitizes the filename by replacing unwanted characters with underscores.
     """
-    return re.sub(r'[^\w\-_\. ]', '_', filename)
+    if filename.isascii():
+        return filename.translate(_SANITIZE_TABLE)
+    return _SANITIZE_RE.sub('_', filename)
+
+def remaining_page_urls(pages):
+    """
+    Builds the URLs of every page after the first from a response's pagination info.
+    Returns None when the info is incomplete, in which case NextPage links must be followed instead.
+    """
+    next_page_url = pages.get("NextPage")
+    total = pages.get("Total")
+    if not (next_page_url and total):
+        return None
+
+    # Only the start value is rewritten, the rest of the query is kept exactly as the server sent it
+    parts = urllib.parse.urlsplit(next_page_url)
+    params = parts.query.split("&")
+    start_index = next((i for i, param in enumerate(params) if param.startswith("start=")), None)
+    if start_index is None:
+        return None
+    try:
+        first_start = int(params[start_index][len("start="):])
+    except ValueError:
+        return None
+
+    # Step by the page size the server actually served, which may be less than the requested count
+    if isinstance(pages.get("Start"), int):
+        per_page = first_start - pages["Start"]
+    else:
+        per_page = pages.get("Count")
+    if not isinstance(per_page, int) or per_page <= 0:
+        return None
+
+    page_urls = []
+    for start in range(first_start, total + 1, per_page):
+        params[start_index] = f"start={start}"
+        page_urls.append(urllib.parse.urlunsplit(parts._replace(query="&".join(params))))
+    return page_urls
+
+def get_image_filename(image, album_name):
+    """
+    Constructs the sanitized filename for an image, suffixed with a short unique identifier.
+    Returns None if the image has nothing to derive an identifier from.
+    """
+    # Get unique identifier
+    unique_id = image.get('ArchivedMD5') or image.get('MD5Sum')
+    if not unique_id:
+        unique_id = image.get('id')
+        if not unique_id:
+            image_uri = image.get('Uri', '')
+            if image_uri:
+                unique_id = xxhash.xxh3_64(image_uri.encode('utf-8')).hexdigest()
+                logging.warning(f"Image in album '{album_name}' is missing 'id' and 'ArchivedMD5'. Using hash of 'Uri' as unique identifier.")
+            else:
+                logging.error(f"Image in album '{album_name}' is missing 'id', 'ArchivedMD5', and 'Uri'. Skipping image.")
+                return None
+
+    # Get filename
+    file_name = image.get("FileName", "unknown_filename")
+    sanitized_filename = sanitize_filename(file_name)
+    name, ext = os.path.splitext(sanitized_filename)
+    short_unique_id = unique_id[:8]
+    return f"{name}_{short_unique_id}{ext}"
+
+async def resolve_download_url(session, image, unique_filename, album_name):
+    """
+    Determines the download URL for an image, or returns None if it has none.
+    """
+    # Prefer the first media type in order that the image has
+    uris = image["Uris"]
+    largest_media = next((media for media in ("LargestVideo", "ImageDownload", "LargestImage") if media in uris), None)
+
+    if largest_media:
+        media_uri = uris[largest_media]["Uri"]
+        image_req = await fetch_json(session, media_uri)
+        if image_req is None:
+            logging.error(f"Could not retrieve image data for {media_uri}. Skipping image.")
+            return None
+        return image_req["Response"][largest_media]["Url"]
+
+    # Use archive link if no suitable URI found
+    download_url = image.get("ArchivedUri")
+    if not download_url:
+        logging.error(f"No download URL found for image '{unique_filename}' in album '{album_name}'. Skipping image.")
+    return download_url
+
+async def download_image(session, sem, image, unique_filename, album_name, image_path):
+    """
+    Resolves the download URL for a single image and saves it to image_path.
+    Errors are logged and never raised, so one bad image cannot abort the other downloads.
+    """
+    async with sem:
+        try:
+            download_url = await resolve_download_url(session, image, unique_filename, album_name)
+        except Exception as e:
+            # Unexpected response shape, e.g. missing "Uris" or "Url" keys
+            logging.error(f"Could not determine download URL for image '{unique_filename}' in album '{album_name}': {e!r}. Skipping image.")
+            return
+        if not download_url:
+            return
+
+        # Download the image
+        try:
+            await fetch_image(session, download_url, image_path)
+            logging.debug(f"Downloaded image: {image_path}")
+        except Exception as e:
+            logging.error(f"Could not fetch image from {download_url}: {e}")
 
 # ---------------------------- #
 #       Main Script Logic      #
 # ---------------------------- #
 
-# Retrieve the list of albums
-logging.info("Retrieving album list...")
-albums_data = get_json(f"/api/v2/folder/user/{args.user}!albumlist")
-if albums_data is None:
-    logging.error("Could not retrieve album list. Exiting.")
-    sys.exit(1)
-logging.info("Album list retrieved successfully.")
-
-# Process album list
-try:
-    album_list = albums_data["Response"]["AlbumList"]
-    if not album_list:
-        logging.warning(f"No albums found for user {args.user}. Exiting.")
-        sys.exit(1)
-except KeyError:
-    logging.error(f"No albums were found for the user {args.user}. The user may not exist or may be password protected.")
-    sys.exit(1)
-
-# Loop through each album
-for album in tqdm(album_list, desc="Albums", unit="album"):
-    album_name = album.get("Name", "Unnamed_Album").strip()
-    if specific_albums and album_name not in specific_albums:
-        continue
-
-    album_url_path = album.get("UrlPath", "").lstrip('/')
-    if not album_url_path:
-        logging.warning(f"Album '{album_name}' has no UrlPath. Skipping.")
-        continue
-
-    album_path = os.path.join(output_dir, album_url_path)
-    if not os.path.exists(album_path):
+async def main():
+    # Connections are capped per host on top of the download semaphore, to avoid CDN throttling
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=args.per_host, ttl_dns_cache=300)
+    # Only stalled sockets time out; a large video on a slow link may take as long as it needs
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    async with aiohttp.ClientSession(connector=connector, cookies=cookies, timeout=timeout) as session:
+        # Retrieve the list of albums
+        logging.info("Retrieving album list...")
+        albums_data = await fetch_json(session, f"/api/v2/folder/user/{args.user}!albumlist")
+        if albums_data is None:
+            logging.error("Could not retrieve album list. Exiting.")
+            sys.exit(1)
+        logging.info("Album list retrieved successfully.")
+
+        # Process album list
         try:
-            os.makedirs(album_path)
-            logging.info(f"Created directory: {album_path}")
-        except OSError as e:
-            logging.error(f"Could not create directory {album_path}: {e}")
-            continue
-
-    # Retrieve images in the album
-    images_data = get_json(f"{album.get('Uri')}!images")
-    if images_data is None:
-        logging.error(f"Could not retrieve images for album '{album_name}'. Skipping.")
-        continue
-
-    images = images_data.get("Response", {}).get("AlbumImage", [])
-    if not images:
-        logging.info(f"No images found in album '{album_name}'. Skipping.")
-        continue
-
-    # Handle pagination
-    next_page_url = images_data["Response"]["Pages"].get("NextPage")
-    while next_page_url:
-        next_images_data = get_json(next_page_url)
-        if next_images_data is None:
-            logging.error(f"Could not retrieve next page for album '{album_name}'.")
-            break
-        next_images = next_images_data.get("Response", {}).get("AlbumImage", [])
-        images.extend(next_images)
-        next_page_url = next_images_data["Response"]["Pages"].get("NextPage")
-
-    # Loop through each image
-    for image in tqdm(images, desc=f"Album: {album_name}", unit="image", leave=False):
-        # Get unique identifier
-        unique_id = image.get('ArchivedMD5') or image.get('MD5Sum')
-        if not unique_id:
-            unique_id = image.get('id')
-            if not unique_id:
-                image_uri = image.get('Uri', '')
-                if image_uri:
-                    unique_id = hashlib.sha256(image_uri.encode('utf-8')).hexdigest()
-                    logging.warning(f"Image in album '{album_name}' is missing 'id' and 'ArchivedMD5'. Using hash of 'Uri' as unique identifier.")
-                else:
-                    logging.error(f"Image in album '{album_name}' is missing 'id', 'ArchivedMD5', and 'Uri'. Skipping image.")
-                    continue
+            album_list = albums_data["Response"]["AlbumList"]
+            if not album_list:
+                logging.warning(f"No albums found for user {args.user}. Exiting.")
+                sys.exit(1)
+        except KeyError:
+            logging.error(f"No albums were found for the user {args.user}. The user may not exist or may be password protected.")
+            sys.exit(1)
+
+        # Collect the images to download from every album first, so a single progress bar can cover them all
+        pending = []
+        for album in tqdm(album_list, desc="Albums", unit="album"):
+            album_name = album.get("Name", "Unnamed_Album").strip()
+            if specific_albums and album_name not in specific_albums:
+                continue
 
-        # Get filename
-        file_name = image.get("FileName", "unknown_filename")
-        sanitized_filename = sanitize_filename(file_name)
-        name, ext = os.path.splitext(sanitized_filename)
-        short_unique_id = unique_id[:8]
-        unique_filename = f"{name}_{short_unique_id}{ext}"
-        image_path = os.path.join(album_path, unique_filename)
-
-        # Check if image already exists
-        if os.path.isfile(image_path):
-            continue  # Already downloaded
-
-        # Determine download URL
-        largest_media = None
-        if "LargestVideo" in image["Uris"]:
-            largest_media = "LargestVideo"
-        elif "ImageDownload" in image["Uris"]:
-            largest_media = "ImageDownload"
-        elif "LargestImage" in image["Uris"]:
-            largest_media = "LargestImage"
-
-        if largest_media and largest_media in image["Uris"]:
-            image_req = get_json(image["Uris"][largest_media]["Uri"])
-            if image_req is None:
-                logging.error(f"Could not retrieve image data for {image['Uris'][largest_media]['Uri']}. Skipping image.")
+            album_url_path = album.get("UrlPath", "").lstrip('/')
+            if not album_url_path:
+                logging.warning(f"Album '{album_name}' has no UrlPath. Skipping.")
                 continue
-            download_url = image_req["Response"][largest_media]["Url"]
-        else:
-            # Use archive link if no suitable URI found
-            download_url = image.get("ArchivedUri")
-            if not download_url:
-                logging.error(f"No download URL found for image '{unique_filename}' in album '{album_name}'. Skipping image.")
+
+            album_path = os.path.join(output_dir, album_url_path)
+            try:
+                os.makedirs(album_path, exist_ok=True)
+                # List the album directory once instead of stat-ing every image
+                existing = {entry.name for entry in os.scandir(album_path)}
+            except OSError as e:
+                logging.error(f"Could not create directory {album_path}: {e}")
                 continue
 
-        # Download the image
-        try:
-            response = requests.get(download_url, cookies=cookies, stream=True)
-            response.raise_for_status()
-            with open(image_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-            logging.debug(f"Downloaded image: {image_path}")
-        except Exception as e:
-            logging.error(f"Could not fetch image from {download_url}: {e}")
-            continue
+            # Retrieve images in the album
+            images_data = await fetch_json(session, f"{album.get('Uri')}!images")
+            if images_data is None:
+                logging.error(f"Could not retrieve images for album '{album_name}'. Skipping.")
+                continue
+
+            images = images_data.get("Response", {}).get("AlbumImage", [])
+            if not images:
+                logging.info(f"No images found in album '{album_name}'. Skipping.")
+                continue
+
+            # Handle pagination, fetching the remaining pages concurrently when possible
+            pages = images_data["Response"]["Pages"]
+            remaining_pages = remaining_page_urls(pages)
+            if remaining_pages:
+                next_pages_data = await asyncio.gather(*(fetch_json(session, page_url) for page_url in remaining_pages))
+                for page_url, next_images_data in zip(remaining_pages, next_pages_data):
+                    if next_images_data is None:
+                        logging.error(f"Could not retrieve page {page_url} for album '{album_name}'.")
+                        continue
+                    images.extend(next_images_data.get("Response", {}).get("AlbumImage", []))
+            else:
+                next_page_url = pages.get("NextPage")
+                while next_page_url:
+                    next_images_data = await fetch_json(session, next_page_url)
+                    if next_images_data is None:
+                        logging.error(f"Could not retrieve next page for album '{album_name}'.")
+                        break
+                    next_images = next_images_data.get("Response", {}).get("AlbumImage", [])
+                    images.extend(next_images)
+                    next_page_url = next_images_data["Response"]["Pages"].get("NextPage")
+
+            # Drop already-downloaded and duplicate images before any API call is made for them.
+            # Image paths share the album's directory prefix, so it is joined only once
+            album_prefix = os.path.join(album_path, "")
+            for image in images:
+                unique_filename = get_image_filename(image, album_name)
+                if unique_filename is None or unique_filename in existing:
+                    continue
+                existing.add(unique_filename)
+                pending.append((image, unique_filename, album_name, album_prefix + unique_filename))
+
+        # Download all images concurrently; the bar only redraws every 50 images or half second
+        sem = asyncio.Semaphore(args.concurrency)
+        with tqdm(total=len(pending), desc="Images", unit="img", mininterval=0.5, miniters=50) as pbar:
+            tasks = []
+            for image, unique_filename, album_name, image_path in pending:
+                task = asyncio.ensure_future(download_image(session, sem, image, unique_filename, album_name, image_path))
+                task.add_done_callback(lambda _: pbar.update(1))
+                tasks.append(task)
+            await asyncio.gather(*tasks)
+
+asyncio.run(main())
 
 logging.info("All downloads completed successfully.")
 print("Completed.")